@@ -1,23 +1,67 @@
 #!/usr/bin/env python3
 import argparse
+import csv
+from functools import partial
+import io
+from multiprocessing import Pool
+import os
+import shutil
+import subprocess
+import tempfile
+import warnings
 
 from cyvcf2 import VCF
 import numpy as np
-import pandas as pd
+import polars as pl
 
-VERSION = "1.0.0"
+VERSION = "1.2.0"
+
+INDEX_EXTENSIONS = (".csi", ".tbi")
+INITIAL_CAPACITY = 1 << 16
+MISSING_STR = (".", "")
+SCHEMA = {
+    "str_id": pl.String,
+    "copy_number": pl.Float32,
+    "frequencies": pl.String,
+    "genotype": pl.String,
+    "depth": pl.Float32,
+    "depth_norm": pl.Float32,
+}
+COLUMNS = tuple(SCHEMA)
+BCFTOOLS_QUERY_FORMAT = "%CHROM\t%POS[\t%CN\t%DP\t%FREQS\t%REPLEN]\n"
+BCFTOOLS_QUERY_SCHEMA = {
+    "chrom": pl.String,
+    "pos": pl.Int64,
+    "copy_number": pl.Float32,
+    "depth": pl.Float32,
+    "frequencies": pl.String,
+    "genotype": pl.String,
+}
 
 DESCRIPTION="\
 description:\n\
-    Create CSV file based on ConSTRain VCF output. CSV file will have six columns:\n\
+    Create CSV or Parquet file based on ConSTRain VCF output. Output will have six columns:\n\
         str_id:         {chromosome id}_{start position} (0-based).\n\
         copy_number:    the number of alleles that exists for this locus in the genome.\n\
-        frequencies:    string representation of Python dict. Keys are allele length, values are observed frequencies.\n\
-        genotype:       string representation of Python list. List the allele lengths of the inferred genotype.\n\
+        frequencies:    FREQS field as written by ConSTRain. Pairs of {allele length},{observed frequency}, separated by '|'.\n\
+        genotype:       REPLEN field as written by ConSTRain. Allele lengths of the inferred genotype, separated by ','.\n\
         depth:          the number of reads that mapped to this locus\n\
-        depth_norm:     depth divided by copy_number.\
+        depth_norm:     depth divided by copy_number. Empty if copy_number is missing or 0.\n\
+    With --bcftools, the fields for Parquet output are extracted with bcftools query instead of cyvcf2.\n\
+    Parquet output is considerably smaller and faster to load for downstream analyses\n\
+    (e.g., with pandas, polars or duckdb), so it is recommended for whole-genome VCF files.\
 " 
 
+def threads_in_range(s: str) -> int:
+    try:
+        threads = int(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError("could not parse value passed to --threads to integer")
+    if threads < 1:
+        raise argparse.ArgumentTypeError("number of threads must be at least 1")
+
+    return threads
+
 def parse_cla():
     parser = argparse.ArgumentParser(
             formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -27,72 +71,249 @@ def parse_cla():
 
     parser.add_argument(
         "-v", "--vcf", type=str, required=True,
-        help="VCF file output by ConSTRain from which to create a CSV file" 
+        help="VCF file output by ConSTRain from which to create a CSV or Parquet file" 
     )
     parser.add_argument(
         "-o", "--output", type=str, required=True,
-        help="File path where the CSV file should be written"
+        help="File path where the output file should be written"
+    )
+    parser.add_argument(
+        "-f", "--format", type=str, choices=("csv", "parquet"), default="csv",
+        help="Output file format. Parquet is recommended for large VCF files (default: csv)"
+    )
+    parser.add_argument(
+        "--bcftools", action="store_true",
+        help="Extract fields with bcftools query instead of cyvcf2. Requires bcftools on PATH and --format parquet. \
+            (NOTE: bcftools reads the VCF file in a single process, so --threads is not used)"
+    )
+    parser.add_argument(
+        "--threads", type=threads_in_range, default=1,
+        help="Number of processes to use. Contigs are processed in parallel, which requires the VCF file to be indexed"
     )
 
     return parser.parse_args()
 
-def df_from_vcf(vcf_file: str) -> pd.DataFrame:
+def open_vcf(vcf_file: str) -> VCF:
     vcf = VCF(vcf_file)
     if len(vcf.samples) != 1:
         raise RuntimeError("this script currently only supports analysing VCF files with exactly one sample")
-    df = {
-        "str_id": [],
-        "copy_number": [],        
-        "frequencies": [],
-        "genotype": [],
-        "depth": [],
-    }
 
-    for variant in vcf:
-        df["str_id"].append(f"{variant.CHROM}_{variant.POS - 1}")
-        df = parse_constrain_format_field(df, variant)
-    
-    df = pd.DataFrame(df).assign(depth_norm = lambda x: x["depth"] / x["copy_number"])
-    return df
+    return vcf
 
-def parse_constrain_format_field(df: dict, variant) -> dict:
-    try:
-        df["copy_number"].append(variant.format("CN")[0][0])
-    except TypeError:
-        df["copy_number"].append(np.nan)
+def is_indexed(vcf_file: str) -> bool:
+    return any(os.path.exists(vcf_file + ext) for ext in INDEX_EXTENSIONS)
 
-    try:
-        df["depth"].append(variant.format("DP")[0][0])
-    except TypeError:
-        df["depth"].append(np.nan)
-    
-    try:
-        frequencies = variant.format("FREQS")[0]
-        freq_dict = dict()
-        for i in frequencies.split("|"):
-            i = i.split(",")
-            freq_dict[int(i[0])] = int(i[1])
-        df["frequencies"].append(freq_dict)            
-    except (TypeError, IndexError):
-        df["frequencies"].append(np.nan)
+def contigs_with_records(vcf: VCF) -> list:
+    # the VCF header lists every target of the BAM file, many of which may have no records.
+    # Checking them here through the index avoids starting a worker for each empty contig.
+    # cyvcf2 warns about every region query that finds nothing, so silence those warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", UserWarning)
+        return [contig for contig in vcf.seqnames if next(vcf(contig), None) is not None]
 
-    try:
-        genotypes = variant.format("REPLEN")[0]
-        if genotypes == ".":
-            raise ValueError
-        genotypes = [int(i) for i in genotypes.split(",")]
-        df["genotype"].append(genotypes)
-    except (TypeError, ValueError):
-        df["genotype"].append(np.nan)
-    
-    return df
+def write_csv(vcf_file: str, output: str, threads: int = 1):
+    vcf = open_vcf(vcf_file)
+    if threads > 1 and not is_indexed(vcf_file):
+        print(f"VCF file {vcf_file} is not indexed, running with a single process")
+        threads = 1
+
+    with open(output, "w", newline="") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(COLUMNS)
+        if threads > 1:
+            # contigs are written in header order, as each contig is parsed by a separate process
+            with Pool(threads) as pool:
+                for chunk in pool.imap(partial(csv_from_region, vcf_file), contigs_with_records(vcf)):
+                    f.write(chunk)
+        else:
+            write_rows(vcf, writer)
+
+def csv_from_region(vcf_file: str, region: str) -> str:
+    buf = io.StringIO()
+    write_rows(VCF(vcf_file)(region), csv.writer(buf, lineterminator="\n"))
+
+    return buf.getvalue()
+
+def write_rows(variants, writer):
+    writerow = writer.writerow
+    for variant in variants:
+        fmt = variant.format
+        copy_number = fmt("CN")
+        copy_number = None if copy_number is None else int(copy_number[0, 0])
+
+        depth = fmt("DP")
+        depth = None if depth is None else int(depth[0, 0])
+
+        frequencies = fmt("FREQS")
+        if frequencies is not None and frequencies[0] not in MISSING_STR:
+            frequencies = frequencies[0]
+        else:
+            frequencies = None
+
+        genotype = fmt("REPLEN")
+        if genotype is not None and genotype[0] not in MISSING_STR:
+            genotype = genotype[0]
+        else:
+            genotype = None
+
+        depth_norm = depth / copy_number if depth is not None and copy_number else None
+
+        writerow((
+            f"{variant.CHROM}_{variant.POS - 1}",
+            copy_number,
+            frequencies,
+            genotype,
+            depth,
+            depth_norm,
+        ))
+
+def write_parquet(vcf_file: str, output: str, threads: int = 1, bcftools: bool = False):
+    df_from_vcf(vcf_file, threads, bcftools).write_parquet(output, compression="snappy")
+
+def df_from_vcf(vcf_file: str, threads: int = 1, bcftools: bool = False) -> pl.DataFrame:
+    if bcftools:
+        if shutil.which("bcftools") is None:
+            raise RuntimeError("bcftools was requested but could not be found on PATH")
+        return df_from_bcftools(vcf_file)
+
+    arrays = arrays_from_vcf(vcf_file, threads)
+
+    # the arrays are already typed, so pass the schema instead of letting polars infer it.
+    # missing numbers are stored as NaN in the arrays, missing strings as None
+    return pl.DataFrame(arrays, schema=SCHEMA, nan_to_null=True)
+
+def df_from_bcftools(vcf_file: str) -> pl.DataFrame:
+    # extract the FORMAT fields with bcftools query so that records are parsed in C
+    open_vcf(vcf_file)
+    # htslib may print a warning for every record, so stderr goes to a file instead of a
+    # pipe that could fill up and block bcftools while stdout is still being read
+    with tempfile.TemporaryFile() as stderr:
+        with subprocess.Popen(
+            ["bcftools", "query", "-f", BCFTOOLS_QUERY_FORMAT, vcf_file],
+            stdout=subprocess.PIPE,
+            stderr=stderr,
+        ) as proc:
+            try:
+                df = pl.read_csv(
+                    proc.stdout,
+                    separator="\t",
+                    has_header=False,
+                    new_columns=list(BCFTOOLS_QUERY_SCHEMA),
+                    schema_overrides=BCFTOOLS_QUERY_SCHEMA,
+                    null_values=".",
+                    quote_char=None,
+                )
+            except pl.exceptions.NoDataError:
+                df = pl.DataFrame(schema=BCFTOOLS_QUERY_SCHEMA)
+            except BaseException:
+                # leaving the with block reaps the process
+                proc.kill()
+                raise
+
+        if proc.returncode != 0:
+            stderr.seek(0)
+            raise RuntimeError(f"bcftools query failed on {vcf_file}: {stderr.read().decode().strip()}")
+
+    # leave depth_norm missing where copy_number is missing or 0, as in the CSV output
+    return df.select(
+        pl.format("{}_{}", "chrom", pl.col("pos") - 1).alias("str_id"),
+        "copy_number",
+        "frequencies",
+        "genotype",
+        "depth",
+        pl.when(pl.col("copy_number") > 0)
+            .then(pl.col("depth") / pl.col("copy_number"))
+            .alias("depth_norm"),
+    )
+
+def arrays_from_vcf(vcf_file: str, threads: int = 1) -> dict:
+    vcf = open_vcf(vcf_file)
+    if threads > 1 and not is_indexed(vcf_file):
+        print(f"VCF file {vcf_file} is not indexed, running with a single process")
+        threads = 1
+
+    if threads > 1:
+        with Pool(threads) as pool:
+            chunks = pool.map(partial(arrays_from_region, vcf_file), contigs_with_records(vcf))
+        if not chunks:
+            chunks = [arrays_from_variants((), 0)]
+        arrays = {k: np.concatenate([chunk[k] for chunk in chunks]) for k in chunks[0]}
+    elif is_indexed(vcf_file):
+        arrays = arrays_from_variants(vcf, vcf.num_records)
+    else:
+        # num_records can only be determined for indexed files, otherwise grow arrays as needed
+        arrays = arrays_from_variants(vcf, INITIAL_CAPACITY)
+
+    # leave depth_norm missing where copy_number is missing or 0, as in the CSV output
+    arrays["depth_norm"] = np.full_like(arrays["depth"], np.nan)
+    np.divide(arrays["depth"], arrays["copy_number"], out=arrays["depth_norm"], where=arrays["copy_number"] > 0)
+
+    return arrays
+
+def arrays_from_region(vcf_file: str, region: str) -> dict:
+    return arrays_from_variants(VCF(vcf_file)(region), INITIAL_CAPACITY)
+
+def arrays_from_variants(variants, n: int) -> dict:
+    str_id = np.empty(n, dtype=object)
+    copy_number = np.empty(n, dtype=np.float32)
+    frequencies = np.empty(n, dtype=object)
+    genotype = np.empty(n, dtype=object)
+    depth = np.empty(n, dtype=np.float32)
+    nan = np.nan
+
+    i = 0
+    for variant in variants:
+        if i == n:
+            n = max(2 * n, INITIAL_CAPACITY)
+            str_id, copy_number, frequencies, genotype, depth = grow_arrays(
+                (str_id, copy_number, frequencies, genotype, depth), n
+            )
+        fmt = variant.format
+        str_id[i] = f"{variant.CHROM}_{variant.POS - 1}"
+
+        value = fmt("CN")
+        copy_number[i] = nan if value is None else value[0, 0]
+
+        value = fmt("DP")
+        depth[i] = nan if value is None else value[0, 0]
+
+        value = fmt("FREQS")
+        frequencies[i] = None if value is None or value[0] in MISSING_STR else value[0]
+
+        value = fmt("REPLEN")
+        genotype[i] = None if value is None or value[0] in MISSING_STR else value[0]
+
+        i += 1
+
+    return {
+        "str_id": str_id[:i],
+        "copy_number": copy_number[:i],
+        "frequencies": frequencies[:i],
+        "genotype": genotype[:i],
+        "depth": depth[:i],
+    }
+
+def grow_arrays(arrays: tuple, n: int) -> tuple:
+    grown = []
+    for arr in arrays:
+        new_arr = np.empty(n, dtype=arr.dtype)
+        new_arr[:arr.shape[0]] = arr
+        grown.append(new_arr)
+
+    return tuple(grown)
 
 def main():
     args = parse_cla()
 
-    df = df_from_vcf(args.vcf)
+    if args.bcftools and args.format != "parquet":
+        raise ValueError("--bcftools is only supported with --format parquet")
+    if args.bcftools and args.threads > 1:
+        print("Extracting fields with bcftools, --threads is not used")
 
-    df.to_csv(args.output, index=False, header=True)
+    if args.format == "parquet":
+        write_parquet(args.vcf, args.output, args.threads, args.bcftools)
+    else:
+        write_csv(args.vcf, args.output, args.threads)
 
 if __name__ == "__main__":
     main()
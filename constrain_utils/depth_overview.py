@@ -1,15 +1,18 @@
 #!/usr/bin/env python3
 import argparse
+from collections import Counter
+from functools import partial
 import json
+from multiprocessing import Pool
 import os
 import time
+import warnings
 
 from cyvcf2 import VCF
 import matplotlib.pyplot as plt
-import pandas as pd
-import seaborn as sns
+import numpy as np
 
-VERSION = "1.0.0"
+VERSION = "1.1.0"
 
 SUPPORTED = (
     ".json",
@@ -29,7 +32,34 @@ SUPPORTED = (
     ".webp",
 )
 
-VCF_SKIP_TAGS = ["CNMISSING", "CNZERO", "DPZERO"]
+# depending on the version, cyvcf2 returns string FORMAT fields as str or bytes
+VCF_SKIP_TAGS = frozenset(t for tag in ("CNMISSING", "CNZERO", "DPZERO") for t in (tag, tag.encode()))
+
+INDEX_EXTENSIONS = (".csi", ".tbi")
+
+# equivalent of seaborn's "poster" plotting context, set directly to avoid importing seaborn
+POSTER_RC = {
+    "axes.linewidth": 2.5,
+    "grid.linewidth": 2,
+    "lines.linewidth": 3.,
+    "lines.markersize": 12,
+    "patch.linewidth": 2,
+    "xtick.major.width": 2.5,
+    "ytick.major.width": 2.5,
+    "xtick.minor.width": 2,
+    "ytick.minor.width": 2,
+    "xtick.major.size": 12,
+    "ytick.major.size": 12,
+    "xtick.minor.size": 8,
+    "ytick.minor.size": 8,
+    "font.size": 24,
+    "axes.labelsize": 24,
+    "axes.titlesize": 24,
+    "xtick.labelsize": 22,
+    "ytick.labelsize": 22,
+    "legend.fontsize": 22,
+    "legend.title_fontsize": 24,
+}
 
 DESCRIPTION="\
 description:\n\
@@ -40,6 +70,17 @@ description:\n\
     ConSTRain on a VCF file with new --min-norm-depth and --max-norm-depth values\n\
     based on the observed depth distribution to filter out outlier loci.\
 " 
+
+def threads_in_range(s: str) -> int:
+    try:
+        threads = int(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError("could not parse value passed to --threads to integer")
+    if threads < 1:
+        raise argparse.ArgumentTypeError("number of threads must be at least 1")
+
+    return threads
+
 def parse_cla():
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -69,28 +110,101 @@ def parse_cla():
                 output plot no matter what, they just won't be considered for determining the bounds \
                     when --include_mononuc is not set)"
     )
+    parser.add_argument(
+        "--threads", type=threads_in_range, default=1,
+        help="Number of processes to use. Contigs are processed in parallel, which requires the VCF file to be indexed"
+    )
 
     return parser.parse_args()
 
-def df_from_vcf(vcf_file: str) -> pd.DataFrame:
+def is_indexed(vcf_file: str) -> bool:
+    return any(os.path.exists(vcf_file + ext) for ext in INDEX_EXTENSIONS)
+
+def contigs_with_records(vcf: VCF) -> list:
+    # the VCF header lists every target of the BAM file, many of which may have no records.
+    # Checking them here through the index avoids starting a worker for each empty contig.
+    # cyvcf2 warns about every region query that finds nothing, so silence those warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", UserWarning)
+        return [contig for contig in vcf.seqnames if next(vcf(contig), None) is not None]
+
+def depth_counts_from_vcf(vcf_file: str, threads: int = 1) -> tuple[Counter, Counter]:
     vcf = VCF(vcf_file)
     if len(vcf.samples) != 1:
         raise RuntimeError("this script currently only supports analysing VCF files with exactly one sample")
-    df = {
-        "period": [],
-        "copy_number": [],
-        "depth": [],
-    }
-
-    for variant in vcf:
-        if any([variant.format("FT")[0] == tag for tag in VCF_SKIP_TAGS]):
+    if threads > 1 and not is_indexed(vcf_file):
+        print(f"VCF file {vcf_file} is not indexed, running with a single process")
+        threads = 1
+
+    if threads <= 1:
+        return count_depths(vcf)
+
+    counts = Counter()
+    counts_polynuc = Counter()
+    with Pool(threads) as pool:
+        for region_counts, region_counts_polynuc in pool.imap_unordered(partial(depth_counts_from_region, vcf_file), contigs_with_records(vcf)):
+            counts.update(region_counts)
+            counts_polynuc.update(region_counts_polynuc)
+
+    return counts, counts_polynuc
+
+def depth_counts_from_region(vcf_file: str, region: str) -> tuple[Counter, Counter]:
+    return count_depths(VCF(vcf_file)(region))
+
+def count_depths(variants) -> tuple[Counter, Counter]:
+    # depth_norm only takes a limited number of distinct values (integer depth divided
+    # by a small integer copy number), so counting them is exact and does not require
+    # keeping every locus in memory
+    counts = Counter()
+    counts_polynuc = Counter()
+    skip_tags = VCF_SKIP_TAGS
+    for variant in variants:
+        fmt = variant.format
+        filter_tag = fmt("FT")
+        if filter_tag is not None and filter_tag.item() in skip_tags:
             continue
-        df["period"].append(variant.INFO.get("PERIOD"))
-        df["copy_number"].append(variant.format("CN")[0][0])
-        df["depth"].append(variant.format("DP")[0][0])
-    
-    df = pd.DataFrame(df).assign(depth_norm = lambda x: x["depth"] / x["copy_number"])
-    return df
+        # skip incomplete records as soon as a field is found to be missing. cyvcf2 reports
+        # missing integers as a negative sentinel, and a copy number of 0 would make
+        # depth_norm infinite even if the record is not tagged CNZERO
+        copy_number = fmt("CN")
+        if copy_number is None or copy_number[0, 0] <= 0:
+            continue
+        depth = fmt("DP")
+        if depth is None or depth[0, 0] < 0:
+            continue
+        period = variant.INFO.get("PERIOD")
+        if period is None:
+            continue
+
+        depth_norm = int(depth[0, 0]) / int(copy_number[0, 0])
+        counts[depth_norm] += 1
+        if period > 1:
+            counts_polynuc[depth_norm] += 1
+
+    return counts, counts_polynuc
+
+def counts_to_arrays(counts: Counter) -> tuple[np.ndarray, np.ndarray]:
+    values = np.fromiter(counts.keys(), dtype=np.float64, count=len(counts))
+    n = np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
+    order = np.argsort(values)
+
+    return values[order], n[order]
+
+def quantile_nearest(values: np.ndarray, n: np.ndarray, q: float) -> float:
+    # same result as the 'nearest' quantile of the array in which each of values is repeated n times
+    cumulative = np.cumsum(n)
+    if cumulative.shape[0] == 0 or cumulative[-1] == 0:
+        raise RuntimeError("no loci left to determine bounds with")
+    idx = np.around(q * (cumulative[-1] - 1))
+
+    return float(values[np.searchsorted(cumulative, idx, side="right")])
+
+def in_range(values: np.ndarray, lower: float, upper: float) -> slice:
+    # values are sorted, so loci with lower <= depth_norm <= upper form a contiguous slice
+    return slice(
+        np.searchsorted(values, lower, side="left"),
+        np.searchsorted(values, upper, side="right"),
+    )
 
 def main():    
     args = parse_cla()
@@ -100,16 +214,18 @@ def main():
 
     print(f"Parsing VCF file {args.vcf}")
     start = time.time()    
-    df = df_from_vcf(args.vcf).dropna()
+    counts, counts_polynuc = depth_counts_from_vcf(args.vcf, args.threads)
     print(f"Read VCF file in {time.time() - start:.2f} seconds")    
 
+    values, n = counts_to_arrays(counts)
     if args.include_mononuc:
-        lower = max(1., df["depth_norm"].quantile(q=args.alpha/2, interpolation="nearest"))
-        upper = df["depth_norm"].quantile(q=1 - (args.alpha/2), interpolation="nearest")
-    else:        
-        lower = max(1., df.query("period > 1")["depth_norm"].quantile(q=args.alpha/2, interpolation="nearest"))
-        upper = df.query("period > 1")["depth_norm"].quantile(q=1 - (args.alpha/2), interpolation="nearest")
-    n_within = df.query(f"depth_norm >= {lower} and depth_norm <= {upper}").shape[0]
+        bounds_values, bounds_n = values, n
+    else:
+        bounds_values, bounds_n = counts_to_arrays(counts_polynuc)
+    lower = max(1., quantile_nearest(bounds_values, bounds_n, args.alpha/2))
+    upper = quantile_nearest(bounds_values, bounds_n, 1 - (args.alpha/2))
+    n_total = int(n.sum())
+    n_within = int(n[in_range(values, lower, upper)].sum())
     
     if ext == ".json":
         print("Writing to json")
@@ -117,7 +233,7 @@ def main():
             "lower": lower,
             "upper": upper,
             "n_within": n_within,
-            "n": df.shape[0],
+            "n": n_total,
         }
         with open(args.output, 'w') as f:
             json.dump(output, f, indent=4)
@@ -127,36 +243,46 @@ def main():
 
         xmin = max(0, lower - 15)
         xmax = upper + 15
-        df_plot = df.query(f"depth_norm >= {xmin} and depth_norm <= {xmax}")
-
-        sns.set_context("poster")
-        fig = plt.figure(dpi=300)    
-        ax = sns.histplot(
-            df_plot,
-            x = "depth_norm",
-            discrete=True,
-            stat="proportion",
-            color="grey",
-        )    
-
-        _ = ax.set(
-            xlabel="Depth / CN",
-            xlim=(xmin, xmax),
-            ylabel="Proportion of STR loci",
-            title=f"Lower bound: {lower}, upper bound: {upper}\nLoci in range: {n_within}/{df.shape[0]} ({n_within/df.shape[0]*100:.2f}%)",
-        )
-
-        _ = ax.vlines(
-            x=[lower, upper],
-            ymin=0, 
-            ymax=ax.get_ylim()[1], 
-            color="black",
-        )
-        print(f"Generated histogram in {time.time() - start:.2f} seconds")
-
-        print(f"Saving plot to {args.output}")
-        plt.savefig(args.output, bbox_inches="tight")
-        plt.close()
+        in_plot = in_range(values, xmin, xmax)
+
+        # one bin per integer depth_norm value, centred on that integer
+        bins = np.floor(values[in_plot] + 0.5).astype(np.int64)
+        first_bin = bins.min()
+        proportions = np.bincount(bins - first_bin, weights=n[in_plot])
+        proportions /= proportions.sum()
+
+        with plt.rc_context(POSTER_RC):
+            fig, ax = plt.subplots(dpi=150)
+            try:
+                ax.bar(
+                    np.arange(first_bin, first_bin + proportions.shape[0]),
+                    proportions,
+                    width=1.,
+                    color="grey",
+                    alpha=.75,
+                    edgecolor="black",
+                    linewidth=.5,
+                )
+
+                _ = ax.set(
+                    xlabel="Depth / CN",
+                    xlim=(xmin, xmax),
+                    ylabel="Proportion of STR loci",
+                    title=f"Lower bound: {lower}, upper bound: {upper}\nLoci in range: {n_within}/{n_total} ({n_within/n_total*100:.2f}%)",
+                )
+
+                _ = ax.vlines(
+                    x=[lower, upper],
+                    ymin=0, 
+                    ymax=ax.get_ylim()[1], 
+                    color="black",
+                )
+                print(f"Generated histogram in {time.time() - start:.2f} seconds")
+
+                print(f"Saving plot to {args.output}")
+                fig.savefig(args.output, bbox_inches="tight")
+            finally:
+                plt.close(fig)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,63 @@
+import shutil
+
+import polars as pl
+from polars.testing import assert_frame_equal
+import pytest
+
+import csv_from_vcf
+
+# Small ConSTRain-style VCF covering passing loci and the ways fields can be missing
+VCF_HEADER = """##fileformat=VCFv4.2
+##contig=<ID=chr1,length=100000>
+##contig=<ID=chr2,length=100000>
+##contig=<ID=chrUn_empty,length=100000>
+##INFO=<ID=END,Number=1,Type=Integer,Description="End position of the variant">
+##INFO=<ID=PERIOD,Number=1,Type=Integer,Description="Repeat period (length of unit)">
+##INFO=<ID=UNIT,Number=1,Type=String,Description="Repeat unit">
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+##FORMAT=<ID=FT,Number=1,Type=String,Description="Filter tag">
+##FORMAT=<ID=CN,Number=1,Type=Integer,Description="Copy number">
+##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Depth">
+##FORMAT=<ID=FREQS,Number=1,Type=String,Description="Allele length frequencies">
+##FORMAT=<ID=REPLEN,Number=1,Type=String,Description="Genotype as allele lengths">
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tsample
+"""
+VCF_RECORDS = [
+    "chr1\t100\t.\tACAC\t.\t.\t.\tEND=104;PERIOD=2;UNIT=AC\tGT:FT:CN:DP:FREQS:REPLEN\t0/0:PASS:2:35:2,32|3,3:2,2",
+    "chr1\t200\t.\tA\t.\t.\t.\tEND=206;PERIOD=1;UNIT=A\tGT:FT:CN:DP:FREQS:REPLEN\t0/0/0:PASS:3:20:6,20:6,6,6",
+    "chr1\t300\t.\tA\t.\t.\t.\tEND=306;PERIOD=1;UNIT=A\tGT:FT:DP:FREQS:REPLEN\t.:CNMISSING:0:.:.",
+    "chr2\t100\t.\tAT\t.\t.\t.\tEND=106;PERIOD=2;UNIT=AT\tGT:FT:CN:DP:FREQS:REPLEN\t.:CNZERO:0:5:3,3|4,2:.",
+    "chr2\t200\t.\tAT\t.\t.\t.\tEND=206;PERIOD=2;UNIT=AT\tGT:FT:CN:DP:FREQS:REPLEN\t.:DPZERO:2:0:.:.",
+]
+
+@pytest.fixture
+def vcf_file(tmp_path):
+    path = tmp_path / "constrain.vcf"
+    path.write_text(VCF_HEADER + "\n".join(VCF_RECORDS) + "\n")
+
+    return str(path)
+
+def test_df_from_vcf(vcf_file):
+    df = csv_from_vcf.df_from_vcf(vcf_file)
+
+    assert df.schema == pl.Schema(csv_from_vcf.SCHEMA)
+    assert df.get_column("str_id").to_list() == ["chr1_99", "chr1_199", "chr1_299", "chr2_99", "chr2_199"]
+    assert df.get_column("frequencies").to_list() == ["2,32|3,3", "6,20", None, "3,3|4,2", None]
+    assert df.get_column("genotype").to_list() == ["2,2", "6,6,6", None, None, None]
+    assert df.get_column("depth_norm").to_list() == [17.5, pytest.approx(20 / 3), None, None, 0.]
+
+def test_csv_matches_df(vcf_file, tmp_path):
+    output = str(tmp_path / "constrain.csv")
+    csv_from_vcf.write_csv(vcf_file, output)
+
+    assert_frame_equal(
+        pl.read_csv(output, schema=csv_from_vcf.SCHEMA),
+        csv_from_vcf.df_from_vcf(vcf_file),
+    )
+
+@pytest.mark.skipif(shutil.which("bcftools") is None, reason="bcftools not found on PATH")
+def test_bcftools_matches_cyvcf2(vcf_file):
+    assert_frame_equal(
+        csv_from_vcf.df_from_vcf(vcf_file, bcftools=True),
+        csv_from_vcf.df_from_vcf(vcf_file),
+    )